@@ -0,0 +1,533 @@
+import bisect
+import contextlib
+import hashlib
+import os
+import tarfile
+import tempfile
+import time
+
+from pmos_backup import compression
+from pmos_backup.throttle import ThrottledWriter
+
+CHUNK_SIZE = 1024 * 1024
+
+# The archive is written as a series of independent compressed members (gzip members, zstd
+# or lz4 frames, xz streams). A new member is started before a file once this many
+# uncompressed bytes have been written since the last one, so decompression can start at
+# any of those points.
+CHECKPOINT_INTERVAL = 4 * 1024 * 1024
+
+# Offset table, stored as the last member of the tar stream in its own compressed member.
+# The archive ends with a codec specific footer that points to it. Besides the offsets it
+# holds the checksum of every regular file and the target of every hard link.
+INDEX_NAME = '.pmos-backup-index'
+
+# Amount of offset table records collected in memory before writing them out
+INDEX_BUFFER = 64 * 1024
+
+
+def new_hash():
+    return hashlib.blake2b(digest_size=32)
+
+
+def hash_bytes(data):
+    h = new_hash()
+    h.update(data)
+    return h.hexdigest()
+
+
+def hash_fileobj(fileobj, size=None):
+    h = new_hash()
+    remaining = size
+    while remaining is None or remaining > 0:
+        length = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+        chunk = fileobj.read(length)
+        if not chunk:
+            break
+        h.update(chunk)
+        if remaining is not None:
+            remaining -= len(chunk)
+    return h.hexdigest()
+
+
+def hash_path(path, size=None):
+    with open(path, 'rb') as handle:
+        return hash_fileobj(handle, size)
+
+
+class FanoutWriter:
+    # Writes the same compressed stream to several files. A destination that fails is
+    # dropped and removed, the backup continues as long as one destination is left.
+
+    def __init__(self, filenames, on_error=None):
+        self.on_error = on_error
+        self.position = 0
+        self.files = []
+        for filename in filenames:
+            try:
+                self.files.append((filename, open(filename, 'wb')))
+            except OSError as e:
+                self._failed(filename, None, e)
+        self._check()
+
+    def _failed(self, filename, handle, error):
+        if handle is not None:
+            self.files.remove((filename, handle))
+            try:
+                handle.close()
+            except OSError:
+                pass
+            # Don't leave a truncated backup behind
+            if os.path.isfile(filename):
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+        if self.on_error:
+            self.on_error(filename, error)
+
+    def _check(self):
+        if not self.files:
+            raise OSError('Writing to all backup targets failed')
+
+    def write(self, data):
+        for filename, handle in list(self.files):
+            try:
+                handle.write(data)
+            except OSError as e:
+                self._failed(filename, handle, e)
+        self._check()
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        for filename, handle in list(self.files):
+            try:
+                handle.flush()
+            except OSError as e:
+                self._failed(filename, handle, e)
+        self._check()
+
+    def close(self):
+        for filename, handle in list(self.files):
+            try:
+                handle.close()
+            except OSError as e:
+                self._failed(filename, handle, e)
+
+    @property
+    def targets(self):
+        return [filename for filename, _ in self.files]
+
+    @property
+    def name(self):
+        # The first destination that is still written to
+        return self.files[0][0]
+
+
+class CheckpointStream:
+    def __init__(self, raw, codec, level):
+        self.raw = raw
+        self.name = raw.name
+        self.codec = codec
+        self.level = level
+        self.position = 0
+        self.size = 0
+        self.footer = None
+        self._dirty = False
+        self._member_offset = 0
+        self._gz = self._open_member()
+
+    def _open_member(self):
+        self._member_offset = self.raw.tell()
+        return self.codec.writer(self.raw, self.level)
+
+    def write(self, data):
+        self._gz.write(data)
+        self.position += len(data)
+        self._dirty = True
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def checkpoint(self):
+        if self._dirty:
+            self._gz.close()
+            self._gz = self._open_member()
+            self._dirty = False
+        return self._member_offset
+
+    def close(self):
+        self._gz.close()
+        if self.footer:
+            self.raw.write(self.footer)
+        self.size = self.raw.tell()
+        self.raw.close()
+
+
+class HashingReader:
+    # Hashes the data while tarfile copies it into the archive, so every file is only read
+    # once. The read throttle is applied to the amount actually read.
+
+    def __init__(self, fileobj, throttle=None):
+        self.fileobj = fileobj
+        self.throttle = throttle
+        self.hash = new_hash()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        if self.throttle is not None:
+            self.throttle.read(len(data))
+        self.hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class InodeMap:
+    # Replacement for the inodes dict of TarFile, storing the (inode, device) keys as a single
+    # int and the member names as bytes.
+    #
+    # TarFile.gettarinfo remembers the inode of every regular file, but it only looks an inode
+    # up for files with more than one link and only those can show up again. An inode that
+    # wasn't looked up right before it is stored belongs to a file with a single link and is
+    # not kept, which saves a second stat call per file to check the link count.
+
+    def __init__(self):
+        self._map = {}
+        self._queried = None
+
+    @staticmethod
+    def _key(inode):
+        return (inode[1] << 64) | inode[0]
+
+    def __contains__(self, inode):
+        self._queried = self._key(inode)
+        return self._queried in self._map
+
+    def __getitem__(self, inode):
+        return self._map[self._key(inode)].decode('utf-8', 'surrogateescape')
+
+    def __setitem__(self, inode, name):
+        key = self._key(inode)
+        if key != self._queried:
+            return
+        self._queried = None
+        self._map[key] = name.encode('utf-8', 'surrogateescape')
+
+    def __len__(self):
+        return len(self._map)
+
+
+def _pwrite_all(handle, data, offset):
+    while data:
+        written = os.pwrite(handle.fileno(), data, offset)
+        data = data[written:]
+        offset += written
+
+
+class ArchiveWriter(tarfile.TarFile):
+    def __init__(self, *args, **kwargs):
+        self._index = None
+        self._index_size = 0
+        self._index_buffer = bytearray()
+        self._index_failed = set()
+        self._checkpoint_offset = 0
+        self.throttle = None
+        super().__init__(*args, **kwargs)
+        self.inodes = InodeMap()
+        if isinstance(self.fileobj, CheckpointStream):
+            self._index = self._index_file()
+            self._record(b'C 0 0\0')
+
+    def _index_file(self):
+        # Offset records go to a temporary file to not keep them all in memory. It is created
+        # next to the backup, /tmp is often a small tmpfs. Any other destination will do if
+        # the directory of the first one can't be written to.
+        targets = getattr(self.fileobj.raw, 'targets', [self.fileobj.name])
+        error = OSError('No directory left for the offset table')
+        for target in targets:
+            directory = os.path.dirname(os.path.abspath(target))
+            if directory in self._index_failed:
+                continue
+            try:
+                handle = tempfile.TemporaryFile(dir=directory, buffering=0)
+            except OSError as e:
+                self._index_failed.add(directory)
+                error = e
+                continue
+            handle.directory = directory
+            return handle
+        raise error
+
+    def _record(self, record):
+        self._index_buffer += record
+        if len(self._index_buffer) >= INDEX_BUFFER:
+            self._flush_index()
+
+    def _flush_index(self):
+        # The buffered records are only dropped once they are written, if the directory of
+        # the temporary file fills up it is moved to another destination
+        while True:
+            try:
+                _pwrite_all(self._index, bytes(self._index_buffer), self._index_size)
+                break
+            except OSError:
+                self._index_failed.add(self._index.directory)
+                self._index = self._move_index()
+        self._index_size += len(self._index_buffer)
+        self._index_buffer.clear()
+
+    def _move_index(self):
+        old = self._index
+        while True:
+            new = self._index_file()
+            try:
+                for offset in range(0, self._index_size, CHUNK_SIZE):
+                    length = min(CHUNK_SIZE, self._index_size - offset)
+                    _pwrite_all(new, os.pread(old.fileno(), length, offset), offset)
+                break
+            except OSError:
+                self._index_failed.add(new.directory)
+                new.close()
+        old.close()
+        return new
+
+    @classmethod
+    def create(cls, filename, pax_headers=None, codec=None, level=None, throttle=None, mirrors=None,
+               on_error=None):
+        if codec is None:
+            codec = compression.CODECS['gzip']
+        if level is None:
+            level = codec.default
+        if mirrors:
+            raw = FanoutWriter([filename] + mirrors, on_error)
+        else:
+            raw = open(filename, 'wb')
+        if throttle is not None:
+            raw = ThrottledWriter(raw, throttle)
+        stream = CheckpointStream(raw, codec, level)
+        tgz = cls(fileobj=stream, mode='w', pax_headers=pax_headers)
+        tgz.throttle = throttle
+        return tgz
+
+    def _checkpoint(self):
+        gz_offset = self.fileobj.checkpoint()
+        self._checkpoint_offset = self.offset
+        self._record(b'C %d %d\0' % (self.offset, gz_offset))
+        return gz_offset
+
+    def addfile(self, tarinfo, fileobj=None):
+        if self.throttle is not None:
+            self.throttle.check()
+
+        reader = None
+        if fileobj is not None and tarinfo.isreg():
+            reader = HashingReader(fileobj, self.throttle)
+            fileobj = reader
+
+        if self._index is not None and self.offset - self._checkpoint_offset >= CHECKPOINT_INTERVAL:
+            self._checkpoint()
+        offset = self.offset
+        super().addfile(tarinfo, fileobj)
+
+        # Nothing reads the member list back while writing, don't let it grow with every file
+        self.members.clear()
+
+        if self._index is not None:
+            digest = reader.hexdigest().encode() if reader is not None else b'-'
+            name = tarinfo.name.encode('utf-8', 'surrogateescape')
+            self._record(b'F %d %s %s\0' % (offset, digest, name))
+            if tarinfo.islnk():
+                linkname = tarinfo.linkname.encode('utf-8', 'surrogateescape')
+                self._record(b'L %d %s\0' % (offset, linkname))
+
+    def _write_index(self):
+        gz_offset = self._checkpoint()
+        tar_offset = self.offset
+        info = tarfile.TarInfo(INDEX_NAME)
+        self._flush_index()
+        info.size = self._index_size
+        info.mtime = int(time.time())
+        self._index.seek(0)
+        tarfile.TarFile.addfile(self, info, self._index)
+        self._index.close()
+        self.fileobj.footer = self.fileobj.codec.footer(gz_offset, tar_offset)
+
+    def close(self):
+        if self.closed:
+            return
+        if self._index is not None:
+            self._write_index()
+        super().close()
+        if isinstance(self.fileobj, CheckpointStream):
+            self.fileobj.close()
+
+
+def _iter_index(handle):
+    # Yields (b'C', tar offset, compressed offset) for the checkpoints,
+    # (b'F', tar offset, (checksum or None, name)) for the members and
+    # (b'L', tar offset, target name) for the hard links, following their F record
+    rest = b''
+    while True:
+        chunk = handle.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        records = (rest + chunk).split(b'\0')
+        rest = records.pop()
+        for record in records:
+            kind, offset, value = record.split(b' ', maxsplit=2)
+            if kind == b'C':
+                yield kind, int(offset), int(value)
+            elif kind == b'L':
+                yield kind, int(offset), value.decode('utf-8', 'surrogateescape')
+            else:
+                digest, name = value.split(b' ', maxsplit=1)
+                digest = None if digest == b'-' else digest.decode()
+                yield kind, int(offset), (digest, name.decode('utf-8', 'surrogateescape'))
+
+
+def _skip(reader, size):
+    while size > 0:
+        chunk = reader.read(min(size, CHUNK_SIZE))
+        if not chunk:
+            break
+        size -= len(chunk)
+
+
+def open_tar(raw, offset=0):
+    # Streaming tarfile for any of the supported codecs, detected from the magic bytes.
+    # Decompression starts at the compressed offset, the start or one of the checkpoints.
+    codec = compression.detect(raw)
+    raw.seek(offset)
+    return tarfile.open(fileobj=codec.reader(raw), mode='r|', errorlevel=2)
+
+
+@contextlib.contextmanager
+def open_archive(filename):
+    with open(filename, 'rb') as raw:
+        with open_tar(raw) as tgz:
+            yield tgz
+
+
+@contextlib.contextmanager
+def open_index(filename):
+    # Iterator over the offset table records (see _iter_index), or None for archives without
+    # an offset table. The records are read as they are consumed.
+    with open(filename, 'rb') as raw:
+        codec = compression.detect(raw)
+        location = codec.read_footer(raw)
+        if location is None:
+            yield None
+            return
+        gz_offset, tar_offset = location
+        raw.seek(gz_offset)
+        with codec.reader(raw) as reader:
+            tgz = tarfile.open(fileobj=reader, mode='r|')
+            fi = tgz.next()
+            if fi is None or fi.name != INDEX_NAME:
+                yield None
+                return
+            yield _iter_index(tgz.extractfile(fi))
+
+
+def find_members(filename, match):
+    # Returns the (tar offset, compressed offset) checkpoints, the (tar offset, name) of the
+    # members accepted by match(name) and the hard link targets the accepted members need,
+    # as {tar offset: (target name, [link names])} for targets that aren't accepted
+    # themselves. Returns None for archives without an offset table.
+    with open_index(filename) as records:
+        if records is None:
+            return None
+        checkpoints = []
+        members = []
+        targets = {}
+        for kind, offset, value in records:
+            if kind == b'C':
+                checkpoints.append((offset, value))
+            elif kind == b'F':
+                if match(value[1]):
+                    members.append((offset, value[1]))
+            elif members and members[-1][0] == offset and not match(value):
+                targets.setdefault(value, []).append(members[-1][1])
+
+    links = {}
+    if targets:
+        # The targets come before the links in the archive, find them in a second pass
+        with open_index(filename) as records:
+            for kind, offset, value in records:
+                if kind == b'F' and value[1] in targets:
+                    links[offset] = (value[1], targets.pop(value[1]))
+    return checkpoints, members, links
+
+
+def iter_seek(filename, checkpoints, offsets):
+    # Yields (tarfile, member) for the members at the given tar offsets, starting
+    # decompression at the nearest checkpoint before them instead of the start of the archive
+    wanted = sorted(offsets)
+    positions = [c[0] for c in checkpoints]
+    with open(filename, 'rb') as raw:
+        codec = compression.detect(raw)
+        tgz = None
+        base = 0
+        i = 0
+        while i < len(wanted):
+            offset = wanted[i]
+            checkpoint = checkpoints[bisect.bisect_right(positions, offset) - 1]
+
+            # Keep reading the open stream unless jumping to the checkpoint skips data
+            if tgz is None or checkpoint[0] > base + tgz.offset:
+                raw.seek(checkpoint[1])
+                reader = codec.reader(raw)
+                _skip(reader, offset - checkpoint[0])
+                base = offset
+                tgz = tarfile.open(fileobj=reader, mode='r|')
+
+            fi = tgz.next()
+            if fi is None:
+                break
+            position = base + fi.offset
+            while i < len(wanted) and wanted[i] < position:
+                i += 1
+            if i < len(wanted) and wanted[i] == position:
+                yield tgz, fi
+                i += 1
+
+
+if __name__ == '__main__':
+    # Memory benchmark of the plain tarfile writer against ArchiveWriter, run it from the
+    # source tree as python3 -m pmos_backup.archive [FILE COUNT]
+    import sys
+    import tracemalloc
+
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, 'source')
+        for i in range(count):
+            directory = os.path.join(source, str(i // 1000))
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, str(i)), 'wb') as handle:
+                handle.write(os.urandom(64))
+
+        writers = [
+            ('tarfile', lambda path: tarfile.open(path, 'w:gz')),
+            ('ArchiveWriter', lambda path: ArchiveWriter.create(path)),
+        ]
+        for label, open_writer in writers:
+            target = os.path.join(workdir, label + '.tar.gz')
+            tracemalloc.start()
+            start = time.monotonic()
+            tgz = open_writer(target)
+            for root, dirs, files in os.walk(source):
+                for fname in files:
+                    tgz.add(os.path.join(root, fname))
+            _, peak = tracemalloc.get_traced_memory()
+            tgz.close()
+            tracemalloc.stop()
+            print(f'{label}: {count} files, peak {peak / 1024 / 1024:.1f} MiB, '
+                  f'{time.monotonic() - start:.1f}s')
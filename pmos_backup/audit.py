@@ -0,0 +1,131 @@
+import hashlib
+import os
+import subprocess
+
+from pmos_backup import cache
+
+INSTALLED_DB = '/lib/apk/db/installed'
+
+# Maximum amount of directories passed to a single apk audit call
+BATCH_SIZE = 256
+
+
+def package_dirs():
+    # The F: lines in the installed database are the directories owned by packages
+    dirs = set()
+    with open(INSTALLED_DB) as handle:
+        for line in handle:
+            if line.startswith('F:'):
+                dirs.add(line[2:].rstrip('\n').strip('/'))
+    return dirs
+
+
+def fingerprint_dir(path):
+    h = hashlib.blake2b(digest_size=8)
+    try:
+        with os.scandir(os.path.join('/', path)) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError:
+        return None
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                h.update(f'{entry.name}/\0'.encode('utf-8', 'surrogateescape'))
+                continue
+            stat = entry.stat(follow_symlinks=False)
+        except OSError:
+            continue
+        h.update(f'{entry.name}\0{stat.st_size}\0{stat.st_mtime_ns}\0{stat.st_ino}\0'
+                 .encode('utf-8', 'surrogateescape'))
+    return h.hexdigest()
+
+
+def _owner(path, dirs):
+    # The package directory a result belongs to, results are re-audited together with it
+    parent = os.path.dirname(path.rstrip('/'))
+    while parent and parent not in dirs:
+        parent = os.path.dirname(parent)
+    return parent
+
+
+def _run_audit(mode, paths=None):
+    cmd = ['apk', 'audit', '--' + mode]
+    if paths is None:
+        return subprocess.check_output(cmd, universal_newlines=True).splitlines()
+    lines = []
+    for i in range(0, len(paths), BATCH_SIZE):
+        batch = [os.path.join('/', p) for p in paths[i:i + BATCH_SIZE]]
+        lines.extend(subprocess.check_output(cmd + batch, universal_newlines=True).splitlines())
+    return lines
+
+
+class AuditCache:
+    # Keeps the apk audit output per package directory together with a fingerprint of the
+    # size, mtime and inode of the files in it. Only directories with a changed fingerprint
+    # are audited again, everything is audited when the package database changes.
+
+    def __init__(self):
+        self.data = cache.load('audit')
+        self.db_key = cache.file_key(INSTALLED_DB)
+        self._dirs = None
+        self._fingerprints = None
+
+    def fingerprints(self):
+        if self._fingerprints is None:
+            self._dirs = package_dirs()
+            self._fingerprints = {d: fingerprint_dir(d) for d in self._dirs}
+        return self._fingerprints
+
+    def audit(self, mode):
+        fingerprints = self.fingerprints()
+        entry = self.data.get(mode)
+
+        results = None
+        if entry is not None and entry['db'] == self.db_key:
+            try:
+                results = self._update(mode, entry)
+            except subprocess.CalledProcessError:
+                # Audit everything like without a cache instead of failing the backup
+                results = None
+        if results is None:
+            results = {}
+            for line in _run_audit(mode):
+                _, path = line.split(' ', maxsplit=1)
+                results.setdefault(_owner(path, self._dirs), []).append(line)
+
+        self.data[mode] = {
+            "db": self.db_key,
+            "fingerprints": fingerprints,
+            "results": results,
+        }
+        lines = []
+        for path in sorted(results):
+            lines.extend(results[path])
+        return lines
+
+    def _update(self, mode, entry):
+        fingerprints = self._fingerprints
+        results = entry['results']
+        changed = set()
+        for path in fingerprints:
+            if entry['fingerprints'].get(path) != fingerprints[path]:
+                changed.add(path)
+        for path in changed:
+            results.pop(path, None)
+        for path in list(results):
+            if path and path not in fingerprints:
+                # Directory is no longer owned by a package
+                del results[path]
+
+        # Directories that can't be read anymore have no files to report, apk fails on them
+        changed = {path for path in changed if fingerprints[path] is not None}
+        if changed:
+            for line in _run_audit(mode, sorted(changed)):
+                _, path = line.split(' ', maxsplit=1)
+                owner = _owner(path, self._dirs)
+                if owner in changed:
+                    results.setdefault(owner, []).append(line)
+        return results
+
+    def save(self):
+        cache.save('audit', self.data)
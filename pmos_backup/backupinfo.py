@@ -1,8 +1,8 @@
-import tarfile
+from pmos_backup import archive
 
 
 def get_info(filename):
-    with tarfile.open(filename, 'r:gz') as tgz:
+    with archive.open_archive(filename) as tgz:
         headers = tgz.pax_headers
     headers['version'] = 'Aha'
     return headers
@@ -0,0 +1,48 @@
+import hashlib
+import json
+import os
+
+CACHE_DIR = '/var/cache/pmos-backup'
+
+
+def load(name):
+    try:
+        with open(os.path.join(CACHE_DIR, name + '.json')) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return {}
+
+
+def save(name, data):
+    path = os.path.join(CACHE_DIR, name + '.json')
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with open(path + '.new', 'w') as handle:
+            json.dump(data, handle)
+        os.replace(path + '.new', path)
+    except OSError:
+        # The cache only makes things faster, running without it is fine
+        pass
+
+
+def file_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def dir_fingerprint(roots):
+    # Adding, removing or renaming files changes the mtime of the directory they are in,
+    # this notices that without stat-ing every file below the roots
+    h = hashlib.blake2b(digest_size=16)
+    for root in roots:
+        for dirpath, dirs, files in os.walk(root):
+            dirs.sort()
+            try:
+                mtime = os.stat(dirpath).st_mtime_ns
+            except OSError:
+                continue
+            h.update(f'{dirpath}\0{mtime}\0'.encode('utf-8', 'surrogateescape'))
+    return h.hexdigest()
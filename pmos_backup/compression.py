@@ -0,0 +1,274 @@
+import gzip
+import lzma
+import os
+import struct
+import tempfile
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Location of the offset table, (compressed offset, tar offset) behind this marker
+FOOTER_MAGIC = b'PMOSBKIX'
+FOOTER_PAYLOAD = FOOTER_MAGIC + b'\x00' * 16
+
+# Amount of sample data and test writes used by the auto mode
+SAMPLE_SIZE = 1024 * 1024
+WRITE_TEST_SIZE = 8 * 1024 * 1024
+
+
+class GzipCodec:
+    name = 'gzip'
+    suffix = '.tar.gz'
+    magic = b'\x1f\x8b'
+    levels = range(1, 10)
+    candidates = [1, 3, 6, 9]
+    default = 6
+
+    # The footer is an empty gzip member with the offsets in its FEXTRA field, so reading the
+    # archive as a plain .tar.gz doesn't produce any extra data
+    _footer_id = b'PB'
+    _footer_size = 42
+
+    def writer(self, raw, level):
+        return gzip.GzipFile(filename='', mode='wb', fileobj=raw, compresslevel=level, mtime=0)
+
+    def reader(self, raw):
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+
+    def footer(self, gz_offset, tar_offset):
+        payload = struct.pack('<QQ', gz_offset, tar_offset)
+        extra = self._footer_id + struct.pack('<H', len(payload)) + payload
+        header = b'\x1f\x8b\x08\x04' + b'\x00\x00\x00\x00' + b'\x00\xff' + struct.pack('<H', len(extra))
+        # Empty deflate block followed by the CRC and size of the empty data
+        return header + extra + b'\x03\x00' + struct.pack('<II', 0, 0)
+
+    def read_footer(self, raw):
+        footer = _read_tail(raw, self._footer_size)
+        if footer[0:4] != b'\x1f\x8b\x08\x04' or footer[12:14] != self._footer_id:
+            return None
+        return struct.unpack('<QQ', footer[16:32])
+
+
+class SkippableFrameFooter:
+    # zstd and lz4 decoders skip frames with a magic number in this range
+    _footer_frame = b'\x50\x2a\x4d\x18'
+
+    def footer(self, gz_offset, tar_offset):
+        payload = FOOTER_MAGIC + struct.pack('<QQ', gz_offset, tar_offset)
+        return self._footer_frame + struct.pack('<I', len(payload)) + payload
+
+    def read_footer(self, raw):
+        size = 8 + len(FOOTER_PAYLOAD)
+        footer = _read_tail(raw, size)
+        if footer[0:4] != self._footer_frame or footer[8:16] != FOOTER_MAGIC:
+            return None
+        return struct.unpack('<QQ', footer[16:32])
+
+
+class ZstdCodec(SkippableFrameFooter):
+    name = 'zstd'
+    suffix = '.tar.zst'
+    module = 'zstandard'
+    magic = b'\x28\xb5\x2f\xfd'
+    levels = range(1, 20)
+    candidates = [1, 3, 6, 10]
+    default = 3
+
+    def writer(self, raw, level):
+        return zstandard.ZstdCompressor(level=level).stream_writer(raw, closefd=False)
+
+    def reader(self, raw):
+        return zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=False)
+
+
+class Lz4Codec(SkippableFrameFooter):
+    name = 'lz4'
+    suffix = '.tar.lz4'
+    module = 'lz4'
+    magic = b'\x04\x22\x4d\x18'
+    levels = range(0, 17)
+    candidates = [0, 3, 9]
+    default = 0
+
+    def writer(self, raw, level):
+        return lz4.frame.LZ4FrameFile(raw, 'wb', compression_level=level)
+
+    def reader(self, raw):
+        return lz4.frame.LZ4FrameFile(raw, 'rb')
+
+
+class XzCodec:
+    name = 'xz'
+    suffix = '.tar.xz'
+    magic = b'\xfd7zXZ\x00'
+    levels = range(0, 10)
+    candidates = [0, 3, 6]
+    default = 6
+
+    # xz has no skippable frames, the footer is a small separate xz stream. Readers of the
+    # whole archive see its contents after the end of the tar archive, where it is ignored.
+
+    def writer(self, raw, level):
+        return lzma.LZMAFile(raw, 'wb', format=lzma.FORMAT_XZ, preset=level)
+
+    def reader(self, raw):
+        return lzma.LZMAFile(raw, 'rb')
+
+    def footer(self, gz_offset, tar_offset):
+        payload = FOOTER_MAGIC + struct.pack('<QQ', gz_offset, tar_offset)
+        return lzma.compress(payload, format=lzma.FORMAT_XZ, check=lzma.CHECK_NONE)
+
+    def read_footer(self, raw):
+        tail = _read_tail(raw, 256)
+        start = tail.rfind(self.magic)
+        while start >= 0:
+            try:
+                payload = lzma.decompress(tail[start:], format=lzma.FORMAT_XZ)
+            except lzma.LZMAError:
+                payload = b''
+            if len(payload) == len(FOOTER_PAYLOAD) and payload.startswith(FOOTER_MAGIC):
+                return struct.unpack('<QQ', payload[8:])
+            start = tail.rfind(self.magic, 0, start)
+        return None
+
+
+CODECS = {
+    'gzip': GzipCodec(),
+    'zstd': ZstdCodec(),
+    'lz4': Lz4Codec(),
+    'xz': XzCodec(),
+}
+
+
+def available():
+    result = ['gzip', 'xz']
+    if zstandard is not None:
+        result.append('zstd')
+    if lz4 is not None:
+        result.append('lz4')
+    return result
+
+
+def _read_tail(raw, size):
+    raw.seek(0, os.SEEK_END)
+    size = min(size, raw.tell())
+    raw.seek(-size, os.SEEK_END)
+    return raw.read(size)
+
+
+def detect(raw):
+    raw.seek(0)
+    head = raw.read(8)
+    raw.seek(0)
+    for codec in CODECS.values():
+        if head.startswith(codec.magic):
+            if codec.name not in available():
+                raise ValueError(f'Archive uses {codec.name} but the {codec.module} module is not installed')
+            return codec
+    raise ValueError('Unknown compression format')
+
+
+def parse(spec):
+    # Returns (codec, level) for a NAME[:LEVEL] specification, 'auto' is resolved by choose()
+    name, _, level = spec.partition(':')
+    if name not in CODECS:
+        raise ValueError(f'Unknown compression: {name}')
+    codec = CODECS[name]
+    if name not in available():
+        raise ValueError(f'Compression {name} is not available, the {codec.module} module is not installed')
+    if not level:
+        return codec, codec.default
+    if int(level) not in codec.levels:
+        raise ValueError(f'Invalid level for {name}: {level}')
+    return codec, int(level)
+
+
+def _sample(paths, size=SAMPLE_SIZE):
+    # A bit of every file until the sample is big enough, so one large file doesn't
+    # dominate the result
+    data = bytearray()
+    for top in paths:
+        for root, dirs, files in os.walk(top):
+            dirs[:] = [d for d in dirs if d != ".cache"]
+            for fname in files:
+                try:
+                    with open(os.path.join(root, fname), 'rb') as handle:
+                        data += handle.read(64 * 1024)
+                except OSError:
+                    continue
+                if len(data) >= size:
+                    return bytes(data[:size])
+    return bytes(data)
+
+
+def measure_write_speed(directory, size=WRITE_TEST_SIZE):
+    block = os.urandom(1024 * 1024)
+    start = time.monotonic()
+    with tempfile.TemporaryFile(dir=directory) as handle:
+        for _ in range(size // len(block)):
+            handle.write(block)
+        handle.flush()
+        os.fsync(handle.fileno())
+    return size / max(time.monotonic() - start, 1e-6)
+
+
+class _Counter:
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def measure_codec(codec, level, sample):
+    counter = _Counter()
+    start = time.monotonic()
+    writer = codec.writer(counter, level)
+    writer.write(sample)
+    writer.close()
+    duration = max(time.monotonic() - start, 1e-6)
+    return len(sample) / duration, counter.size / max(len(sample), 1)
+
+
+def estimate_ratio(codec, level, sample_paths):
+    # Compression ratio of a sample of the data, for when there are no previous backups to
+    # take it from
+    sample = _sample(sample_paths)
+    if not sample:
+        return 1.0
+    return measure_codec(codec, level, sample)[1]
+
+
+def choose(directory, sample_paths):
+    # Pick the codec and level with the highest end-to-end throughput, the backup is limited
+    # either by the compression speed or by how fast the compressed data can be written.
+    # Candidates within 5% of the best throughput are considered equal and the one with the
+    # best compression wins.
+    write_speed = measure_write_speed(directory)
+    sample = _sample(sample_paths)
+    if not sample:
+        return CODECS['gzip'], GzipCodec.default
+
+    results = []
+    for name in available():
+        codec = CODECS[name]
+        for level in codec.candidates:
+            speed, ratio = measure_codec(codec, level, sample)
+            throughput = min(speed, write_speed / max(ratio, 1e-6))
+            results.append((throughput, ratio, codec, level))
+
+    best = max(r[0] for r in results)
+    throughput, ratio, codec, level = min((r for r in results if r[0] >= best * 0.95), key=lambda r: r[1])
+    return codec, level
@@ -0,0 +1,155 @@
+import errno
+import grp
+import os
+import pwd
+import shutil
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class Extractor:
+    # Replacement for TarFile.extract when restoring many files. Directories that are known
+    # to exist are remembered instead of checking every parent again, regular files get their
+    # owner, mode and mtime set through the open file descriptor and the metadata of the
+    # directories is applied in a final pass so it isn't changed again by the files created in
+    # them afterwards. Nothing is synced to disk until all files are written.
+    #
+    # Hard links whose target isn't restored get the data of the target written under their
+    # own name, either from extract_link_target() or from the (tarfile, member) pairs returned
+    # by link_source(target name).
+
+    def __init__(self, root='/', link_source=None):
+        self.root = root
+        self.link_source = link_source
+        self.copied = set()
+        self.dirs = set()
+        self.deferred = []
+        self.is_root = hasattr(os, 'geteuid') and os.geteuid() == 0
+        self._uids = {}
+        self._gids = {}
+
+    def _path(self, name):
+        parts = name.split('/')
+        if name.startswith('/') or '..' in parts:
+            raise ValueError(f'Refusing to extract {name} outside of {self.root}')
+        return os.path.join(self.root, name)
+
+    def _make_parents(self, path):
+        parent = os.path.dirname(path)
+        if parent in self.dirs:
+            return
+        os.makedirs(parent, exist_ok=True)
+        while parent not in self.dirs and parent != self.root and parent != '/':
+            self.dirs.add(parent)
+            parent = os.path.dirname(parent)
+
+    def _owner(self, fi):
+        # Same as tarfile, prefer the user and group names over the stored ids
+        key = (fi.uname, fi.uid)
+        if key not in self._uids:
+            try:
+                self._uids[key] = pwd.getpwnam(fi.uname).pw_uid
+            except KeyError:
+                self._uids[key] = fi.uid
+        key = (fi.gname, fi.gid)
+        if key not in self._gids:
+            try:
+                self._gids[key] = grp.getgrnam(fi.gname).gr_gid
+            except KeyError:
+                self._gids[key] = fi.gid
+        return self._uids[(fi.uname, fi.uid)], self._gids[(fi.gname, fi.gid)]
+
+    def _remove(self, path):
+        if os.path.lexists(path) and not os.path.isdir(path):
+            os.unlink(path)
+
+    def extract(self, tgz, fi):
+        path = self._path(fi.name)
+        self._make_parents(path)
+
+        if fi.isdir():
+            if path not in self.dirs:
+                try:
+                    os.mkdir(path, 0o700)
+                except FileExistsError:
+                    pass
+                self.dirs.add(path)
+            self.deferred.append((path, fi))
+        elif fi.isreg():
+            self._write_file(tgz, fi, path)
+        elif fi.issym():
+            self._remove(path)
+            os.symlink(fi.linkname, path)
+            if self.is_root:
+                os.lchown(path, *self._owner(fi))
+            os.utime(path, (fi.mtime, fi.mtime), follow_symlinks=False)
+        elif fi.islnk():
+            if path in self.copied:
+                return
+            self._remove(path)
+            target = self._path(fi.linkname)
+            if os.path.lexists(target):
+                os.link(target, path)
+            else:
+                self._copy_link(fi, path)
+        else:
+            # Device nodes and fifos are rare enough to leave them to tarfile
+            tgz.extract(fi, self.root)
+
+    def _copy_link(self, fi, path):
+        if self.link_source is not None:
+            for tgz, target in self.link_source(fi.linkname):
+                self._write_file(tgz, target, path)
+                return
+        raise FileNotFoundError(errno.ENOENT, 'Hard link target was not restored', fi.linkname)
+
+    def extract_link_target(self, tgz, fi, names):
+        # For a member that is only needed as the target of the hard links in names. If the
+        # target doesn't exist its data is written under the first link name and the other
+        # links point to that.
+        if os.path.lexists(self._path(fi.name)):
+            return
+        first = None
+        for name in names:
+            path = self._path(name)
+            self._make_parents(path)
+            if first is None:
+                self._write_file(tgz, fi, path)
+                first = path
+            else:
+                self._remove(path)
+                os.link(first, path)
+            self.copied.add(path)
+
+    def _write_file(self, tgz, fi, path):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW | os.O_CLOEXEC
+        try:
+            fd = os.open(path, flags, 0o600)
+        except OSError:
+            # Replace symlinks and other non-regular files instead of writing through them
+            self._remove(path)
+            fd = os.open(path, flags, 0o600)
+
+        with os.fdopen(fd, 'wb') as handle:
+            shutil.copyfileobj(tgz.extractfile(fi), handle, CHUNK_SIZE)
+            handle.flush()
+            if self.is_root:
+                os.fchown(fd, *self._owner(fi))
+            # chmod after chown, changing the owner clears the setuid bits
+            os.fchmod(fd, fi.mode & 0o7777)
+            os.utime(fd, (fi.mtime, fi.mtime))
+
+    def finish(self):
+        # Deepest directories first, like GNU tar does with its delayed set_stat list
+        errors = []
+        for path, fi in sorted(self.deferred, key=lambda d: d[0], reverse=True):
+            try:
+                if self.is_root:
+                    os.chown(path, *self._owner(fi))
+                os.chmod(path, fi.mode & 0o7777)
+                os.utime(path, (fi.mtime, fi.mtime))
+            except OSError as e:
+                errors.append(e)
+        self.deferred = []
+        os.sync()
+        return errors
@@ -0,0 +1,81 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Amount of files handed to the kernel for read-ahead before the archiver gets to them
+DEPTH = 32
+
+# Only the start of large files is prefetched, the kernel read-ahead takes over from there
+PREFETCH_BYTES = 2 * 1024 * 1024
+
+
+def walk_files(top, skip=None):
+    # Like os.walk but yielding (path, is regular file) for every non-directory entry with
+    # the entries of each directory sorted by inode number, which follows the on-disk layout
+    # on most filesystems more closely than the readdir order. Getting the inode number of a
+    # DirEntry doesn't need a stat call.
+    stack = [top]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda e: e.inode())
+        except OSError:
+            continue
+
+        subdirs = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                # Like os.walk, symlinks to directories are neither followed nor returned
+                if not entry.is_symlink() and (skip is None or entry.name not in skip):
+                    subdirs.append(entry.path)
+                continue
+            try:
+                regular = entry.is_file(follow_symlinks=False)
+            except OSError:
+                regular = False
+            yield entry.path, regular
+        stack.extend(reversed(subdirs))
+
+
+def _prefetch(path):
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, PREFETCH_BYTES, os.POSIX_FADV_WILLNEED)
+        else:
+            os.read(fd, PREFETCH_BYTES)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def prefetch(files, workers=4, depth=DEPTH):
+    # Pass through the (path, is regular file) pairs in order while a thread pool asks the
+    # kernel to start reading the next files, so the storage latency overlaps with compression
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for path, regular in files:
+            future = pool.submit(_prefetch, path) if regular else None
+            pending.append((path, future))
+            if len(pending) > depth:
+                yield _next(pending)
+        while pending:
+            yield _next(pending)
+
+
+def _next(pending):
+    path, future = pending.popleft()
+    if future is not None:
+        # Prefetching a file the archiver is about to read is pointless, this also keeps the
+        # queue of the pool bounded when the storage is slower than the archiver
+        future.cancel()
+    return path
@@ -2,18 +2,31 @@ import os
 import sys
 import subprocess
 import shutil
+import fnmatch
 import glob
 import json
 import pathlib
 import shlex
-import tarfile
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from pmos_backup import archive
+from pmos_backup import audit
+from pmos_backup import cache
+from pmos_backup import compression
+from pmos_backup import extract
+from pmos_backup import prefetch
+from pmos_backup import throttle
+
 _progress_json = False
+_progress_muted = False
 
 
 def _progress(value, label):
+    if _progress_muted:
+        return
     if _progress_json:
         print(json.dumps({"progress": value, "label": label}))
         sys.stdout.flush()
@@ -29,6 +42,46 @@ def _error(message):
         sys.stderr.write(message + "\n")
 
 
+def _mismatch(path, reason):
+    if _progress_json:
+        print(json.dumps({"mismatch": {"path": path, "reason": reason}}))
+        sys.stdout.flush()
+    else:
+        sys.stderr.write(f"{reason}: {path}\n")
+
+
+def _paused(reason):
+    if _progress_json:
+        print(json.dumps({"paused": reason}))
+        sys.stdout.flush()
+    else:
+        sys.stderr.write(f"Paused: {reason}\n")
+
+
+def _target_failed(filename, error):
+    _error(f"Writing the backup to {filename} failed: {error}")
+
+
+def _estimate(estimate):
+    if _progress_json:
+        print(json.dumps({"estimate": estimate}))
+        sys.stdout.flush()
+    else:
+        message = f"Estimated backup size: {sizeof_fmt(estimate['size'])}"
+        if 'seconds' in estimate:
+            message += f", duration: {estimate['seconds'] // 60} min"
+        sys.stderr.write(message + "\n")
+
+
+def _stats(stats):
+    if _progress_json:
+        print(json.dumps({"stats": stats}))
+        sys.stdout.flush()
+    else:
+        for key in stats:
+            sys.stderr.write(f"{key}: {stats[key]}\n")
+
+
 def parse_apk_cache():
     result = {}
     for path in glob.glob('/etc/apk/cache/*.apk'):
@@ -97,12 +150,14 @@ def import_backup(source, target):
         exit(1)
 
 
-def save_system_state(target, version, measure=False, do_config=True, do_system=True, do_apks=True, do_homedirs=True):
+def save_system_state(target, version, measure=False, do_config=True, do_system=True, do_apks=True, do_homedirs=True,
+                      limits=None, mirrors=None, codec=None, level=None):
     pscale = 1
     if not do_homedirs:
         pscale = 2
     errors = []
     tgz = None
+    audits = audit.AuditCache()
     if not measure:
         os.makedirs(os.path.dirname(target), exist_ok=True)
 
@@ -124,7 +179,12 @@ def save_system_state(target, version, measure=False, do_config=True, do_system=
                 distro[k] = v.strip('"')
         headers['os-version'] = distro['VERSION_ID']
 
-        tgz = tarfile.open(target, 'w:gz', pax_headers=headers)
+        if codec is None:
+            codec, level = compression.parse('gzip')
+        headers['compression'] = f'{codec.name}:{level}'
+
+        tgz = archive.ArchiveWriter.create(target, pax_headers=headers, codec=codec, level=level,
+                                           throttle=limits, mirrors=mirrors, on_error=_target_failed)
 
     if not measure:
         # Copy over the apk state and some metadata about the installation
@@ -137,8 +197,7 @@ def save_system_state(target, version, measure=False, do_config=True, do_system=
     config_size = 0
     if do_config:
         _progress(20 * pscale, "Checking modified config")
-        modified_config = subprocess.check_output(['apk', 'audit', '--backup'], universal_newlines=True)
-        for line in modified_config.splitlines():
+        for line in audits.audit('backup'):
             state, path = line.split(' ', maxsplit=1)
             if state in ['A', 'U']:
                 source = os.path.join('/', path)
@@ -152,8 +211,7 @@ def save_system_state(target, version, measure=False, do_config=True, do_system=
     system_size = 0
     if do_system:
         _progress(30 * pscale, "Checking modified system files")
-        modified_system = subprocess.check_output(['apk', 'audit', '--system'], universal_newlines=True)
-        for line in modified_system.splitlines():
+        for line in audits.audit('system'):
             state, path = line.split(' ', maxsplit=1)
 
             # Don't copy generated python cache files which show up in the system audit
@@ -192,6 +250,8 @@ def save_system_state(target, version, measure=False, do_config=True, do_system=
                         else:
                             tgz.add(path)
 
+    audits.save()
+
     if measure:
         return {
             "errors": errors,
@@ -208,37 +268,35 @@ def save_system_state(target, version, measure=False, do_config=True, do_system=
         return tgz
 
 
-def save_homedirs(target, tgz):
+def save_homedirs(target, tgz, count=None, mirrors=None):
     errors = []
     _progress(50, "Copying homedirs")
 
-    # Count the total files for progress calculations
-    count = 0
-    for root, dirs, files in os.walk('/home', topdown=True):
-        # Skip cache dirs
-        dirs[:] = [d for d in dirs if d != ".cache"]
-        for fname in files:
-            count += 1
-
-    # Do the actual copy
+    # Count the total files for progress calculations, unless the pre-flight
+    # measurement already did
+    if count is None:
+        count = 0
+        for root, dirs, files in os.walk('/home', topdown=True):
+            # Skip cache dirs
+            dirs[:] = [d for d in dirs if d != ".cache"]
+            for fname in files:
+                count += 1
+
+    # Do the actual copy, in on-disk order and with the next files being read ahead
     done = 0
-    for root, dirs, files in os.walk('/home', topdown=True):
-        dirs[:] = [d for d in dirs if d != ".cache"]
-
-        for fname in files:
-            path = os.path.join(root, fname)
-            try:
-                if path == target:
-                    continue
-                tgz.add(path)
-            except Exception as e:
-                errors.append(str(e))
+    for path in prefetch.prefetch(prefetch.walk_files('/home', skip=[".cache"])):
+        try:
+            if path == target or (mirrors and path in mirrors):
+                continue
+            tgz.add(path)
+        except Exception as e:
+            errors.append(str(e))
 
-            done += 1
+        done += 1
 
-            # Rate limit the progress updates to save resources
-            if done % 50 == 0:
-                _progress(int(50 + (done / count * 50.0)), "Copying homedirs")
+        # Rate limit the progress updates to save resources
+        if done % 50 == 0:
+            _progress(int(50 + (min(done / max(count, 1), 1) * 50.0)), "Copying homedirs")
 
     logfile = os.path.join(os.path.dirname(target), 'backup.log')
     with open(logfile, 'a') as handle:
@@ -247,6 +305,126 @@ def save_homedirs(target, tgz):
             handle.write(f'{error}\n')
 
 
+def measure_homedirs(previous):
+    # Maps every directory to [mtime, bytes, files] for the files directly in it. Directories
+    # with an unchanged mtime reuse the previous numbers instead of stat-ing all their files.
+    current = {}
+    total_bytes = 0
+    total_files = 0
+    for root, dirs, files in os.walk('/home', topdown=True):
+        dirs[:] = [d for d in dirs if d != ".cache"]
+        try:
+            mtime = os.stat(root).st_mtime_ns
+        except OSError:
+            continue
+        entry = previous.get(root)
+        if entry is None or entry[0] != mtime:
+            size = 0
+            for fname in files:
+                try:
+                    size += os.lstat(os.path.join(root, fname)).st_size
+                except OSError:
+                    pass
+            entry = [mtime, size, len(files)]
+        current[root] = entry
+        total_bytes += entry[1]
+        total_files += entry[2]
+    return total_bytes, total_files, current
+
+
+def measure_backup(do_config=True, do_system=True, do_apks=True, do_homedirs=True):
+    data = cache.load('measure')
+
+    # The audit results only change when packages change or files get added, removed or
+    # replaced in the package directories
+    roots = [r for r in ['/bin', '/etc', '/lib', '/opt', '/sbin', '/usr'] if os.path.isdir(r)]
+    key = {
+        "installed": cache.file_key('/lib/apk/db/installed'),
+        "world": cache.file_key('/etc/apk/world'),
+        "apk-cache": cache.file_key('/etc/apk/cache'),
+        "dirs": cache.dir_fingerprint(roots),
+    }
+    if data.get('key') != key or 'state' not in data:
+        data['state'] = save_system_state(None, None, measure=True)
+        data['key'] = key
+
+    state = data['state']
+    result = {
+        "errors": state['errors'],
+        "config": state['config'] if do_config else 0,
+        "system": state['system'] if do_system else 0,
+        "cache": state['cache'] if do_apks else 0,
+        "homedirs": 0,
+        "files": 0,
+    }
+    if do_homedirs:
+        _progress(50, "Measuring homedirs")
+        size, files, data['homedirs'] = measure_homedirs(data.get('homedirs', {}))
+        result['homedirs'] = size
+        result['files'] = files
+
+    cache.save('measure', data)
+    return result
+
+
+def preflight(targets, sizes, codec=None, level=None, sources=None):
+    history = cache.load('measure').get('history', [])
+    total = sizes['config'] + sizes['system'] + sizes['cache'] + sizes['homedirs']
+
+    # Use the compression ratio and speed of the previous backups, without history
+    # compress a sample of the data to get the ratio
+    read = sum(run['input'] for run in history)
+    written = sum(run['output'] for run in history)
+    seconds = sum(run['seconds'] for run in history)
+    if read:
+        ratio = written / read
+    else:
+        if codec is None:
+            codec = compression.CODECS['gzip']
+        ratio = compression.estimate_ratio(codec, level or codec.default, sources or ['/etc'])
+    estimate = {"input": total, "size": int(total * ratio)}
+    if seconds:
+        estimate['seconds'] = int(total / (read / seconds))
+    _estimate(estimate)
+
+    # Like a failed write, a destination without enough space is dropped and the backup
+    # goes to the others. Returns the destinations that are left.
+    result = []
+    for target in targets:
+        directory = os.path.dirname(target)
+        os.makedirs(directory, exist_ok=True)
+        free = shutil.disk_usage(directory).free
+        if estimate['size'] > free:
+            _error(f"Not enough space for the backup in {directory}, it needs about "
+                   f"{sizeof_fmt(estimate['size'])} but only {sizeof_fmt(free)} is available")
+            continue
+        result.append(target)
+    return result
+
+
+def record_run(tgz, seconds):
+    data = cache.load('measure')
+    history = data.get('history', [])
+    history.append({
+        "input": tgz.offset,
+        "output": tgz.fileobj.size,
+        "seconds": seconds,
+    })
+    data['history'] = history[-10:]
+    cache.save('measure', data)
+
+
+def prune_backups(directory, keep):
+    # The scheduled backups are named after their start time, sorting the names sorts them
+    # by age
+    backups = sorted(glob.glob(os.path.join(directory, '*.backup.tar*')))
+    for path in backups[:-keep]:
+        try:
+            os.unlink(path)
+        except OSError as e:
+            _error(f'Could not remove old backup {path}: {e}')
+
+
 def removeprefix(data, prefix):
     if data.startswith(prefix):
         return data[len(prefix):]
@@ -293,7 +471,7 @@ def restore_packages(source, restore_sideloaded=True, cross_branch=False):
 
 
 def classify(path):
-    if path == 'etc/os-release':
+    if path == 'etc/os-release' or path == archive.INDEX_NAME:
         return None
     elif path.startswith('etc/apk/cache'):
         return 'sideloaded'
@@ -315,24 +493,87 @@ def classify(path):
     return 'system'
 
 
-def get_archive_info(filename):
-    contents = {}
+def iter_members(tgz):
+    # TarFile remembers every member it has read in tgz.members, which grows without
+    # bound on large archives. Walk the archive with next() and forget them again.
+    while True:
+        fi = tgz.next()
+        if fi is None:
+            break
+        tgz.members.clear()
+        yield fi
+
+
+def decode_names(data):
+    start = 0
+    while start < len(data):
+        end = data.index(b'\0', start)
+        yield bytes(data[start:end]).decode('utf-8', 'surrogateescape')
+        start = end + 1
+
+
+def get_archive_summary(filename, names=False):
     size = {}
-    with tarfile.open(filename, 'r:gz', errorlevel=2) as tgz:
-        for fi in tgz:
+    count = {}
+    listing = {} if names else None
+    with archive.open_archive(filename) as tgz:
+        for fi in iter_members(tgz):
             cat = classify(fi.name)
             if cat:
-                if cat not in contents:
-                    contents[cat] = []
+                if cat not in size:
                     size[cat] = 0
-                contents[cat].append(fi.name)
+                    count[cat] = 0
+                    if names:
+                        listing[cat] = bytearray()
                 size[cat] += fi.size
-    return size, contents
+                count[cat] += 1
+                if names:
+                    # Store the names as NUL separated bytes instead of a list of str objects
+                    listing[cat] += fi.name.encode('utf-8', 'surrogateescape') + b'\0'
+    return size, count, listing
+
+
+def group_categories(size, count):
+    # Returns the category tree together with copies of size and count that also have
+    # the totals of the parent categories
+    tree = {}
+    size = dict(size)
+    count = dict(count)
+    for key in size:
+        if '.' in key:
+            key, _ = key.split('.', maxsplit=1)
+        if key not in tree:
+            tree[key] = []
+    for key in sorted(size):
+        if '.' not in key:
+            continue
+        skey = key
+        key, subkey = key.split('.', maxsplit=1)
+        tree[key].append(subkey)
+        if key not in size:
+            size[key] = 0
+            count[key] = 0
+        size[key] += size[skey]
+        count[key] += count[skey]
+    return tree, size, count
+
+
+def _link_source(filename):
+    # Finds the target of a hard link through the offset table, for links to files that
+    # weren't restored
+    def source(name):
+        found = archive.find_members(filename, lambda n: n == name)
+        if found is None or not found[1]:
+            return []
+        checkpoints, members, _ = found
+        return archive.iter_seek(filename, checkpoints, [members[0][0]])
+
+    return source
 
 
 def restore(filename, filter, skip_repositories=False):
     errors = []
-    size, contents = get_archive_info(filename)
+    size, count, _ = get_archive_summary(filename)
     total_bytes = 0
     current_bytes = 0
     last_bytes = 0
@@ -340,8 +581,9 @@ def restore(filename, filter, skip_repositories=False):
         if key in filter:
             total_bytes += size[key]
 
-    with tarfile.open(filename, 'r:gz', errorlevel=2) as tgz:
-        for fi in tgz:
+    extractor = extract.Extractor("/", link_source=_link_source(filename))
+    with archive.open_archive(filename) as tgz:
+        for fi in iter_members(tgz):
             try:
                 # Never overwrite the distro release info
                 if fi.name == "etc/os-release":
@@ -359,7 +601,7 @@ def restore(filename, filter, skip_repositories=False):
                                     if line.startswith('device-'):
                                         pkgs.append(line.strip())
 
-                            world = tgz.extractfile(fi).read()
+                            world = tgz.extractfile(fi).read().decode()
                             for line in world.splitlines():
                                 if '><' in line and not sideloaded:
                                     continue
@@ -372,9 +614,9 @@ def restore(filename, filter, skip_repositories=False):
                         elif fi.name == 'etc/apk/repositories' and skip_repositories:
                             pass
                         else:
-                            tgz.extract(fi, "/")
+                            extractor.extract(tgz, fi)
                     else:
-                        tgz.extract(fi, "/")
+                        extractor.extract(tgz, fi)
                     current_bytes += fi.size
                     if current_bytes - last_bytes > 1024 * 1024:
                         _progress(current_bytes / total_bytes * 100, "Restoring backup")
@@ -382,11 +624,209 @@ def restore(filename, filter, skip_repositories=False):
 
             except Exception as e:
                 errors.append(e)
+    errors.extend(extractor.finish())
     if 'packages' in filter:
         _progress(100, "Running package manager")
         subprocess.run(['apk', 'fix'])
 
 
+def _path_matcher(patterns):
+    patterns = [p.strip('/') for p in patterns]
+
+    def match(name):
+        for pattern in patterns:
+            if name == pattern or name.startswith(pattern + '/') or fnmatch.fnmatchcase(name, pattern):
+                return True
+        return False
+
+    return match
+
+
+def restore_path(filename, patterns):
+    errors = []
+    match = _path_matcher(patterns)
+    extractor = extract.Extractor("/", link_source=_link_source(filename))
+
+    def restore_member(tgz, fi):
+        # Never overwrite the distro release info
+        if classify(fi.name) is None:
+            return
+        try:
+            extractor.extract(tgz, fi)
+        except Exception as e:
+            errors.append(e)
+
+    found = archive.find_members(filename, match)
+    if found is None:
+        # Older archives have no offset table, fall back to reading through the whole archive
+        _progress(0, "Searching backup")
+        with archive.open_archive(filename) as tgz:
+            for fi in iter_members(tgz):
+                if match(fi.name):
+                    restore_member(tgz, fi)
+    else:
+        checkpoints, members, links = found
+        offsets = [m[0] for m in members] + list(links)
+        targets = dict(links.values())
+        done = 0
+        for tgz, fi in archive.iter_seek(filename, checkpoints, offsets):
+            if fi.name in targets:
+                try:
+                    extractor.extract_link_target(tgz, fi, targets[fi.name])
+                except Exception as e:
+                    errors.append(e)
+                continue
+            restore_member(tgz, fi)
+            done += 1
+            if done % 50 == 0:
+                _progress(done / len(members) * 100, "Restoring files")
+
+    errors.extend(extractor.finish())
+    for error in errors:
+        _error(str(error))
+    _progress(100, "Restoring files")
+
+
+def _verify_member(name, expected, data, compare):
+    if data is not None and archive.hash_bytes(data) != expected:
+        return 'corrupt'
+    if compare:
+        source = os.path.join('/', name)
+        if not os.path.isfile(source):
+            return 'missing'
+        try:
+            if archive.hash_path(source) != expected:
+                return 'changed'
+        except OSError:
+            return 'unreadable'
+    return None
+
+
+def verify(filename, compare=False, jobs=None):
+    # Members up to this size are decompressed in one go and hashed on the worker pool,
+    # larger ones are hashed while streaming to keep the memory use bounded
+    inline_limit = 8 * 1024 * 1024
+    pending_limit = 64 * 1024 * 1024
+
+    start = time.monotonic()
+    total = os.path.getsize(filename)
+    files = 0
+    unchecked = 0
+    checked_bytes = 0
+    mismatches = 0
+    pending = deque()
+    pending_bytes = 0
+    last_progress = 0
+
+    def finish(job):
+        nonlocal mismatches
+        name, future, size = job
+        try:
+            reason = future.result()
+        except Exception:
+            reason = 'unreadable'
+        if reason:
+            mismatches += 1
+            _mismatch(name, reason)
+        return size
+
+    # A damaged spot can fail in the tar parser or in any of the decompressors. Verification
+    # continues at the next checkpoint after it, the members in between can't be read.
+    found = archive.find_members(filename, lambda name: False)
+    checkpoints = found[0] if found is not None else []
+
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as pool, \
+            open(filename, 'rb') as raw, \
+            archive.open_index(filename) as records:
+        # The checksums come from the offset table, which lists the members in the same
+        # order as the archive. Archives without one can't be checked.
+        record = next(records, None) if records is not None else None
+        base = 0
+        offset = 0
+        position = -1
+        while True:
+            current = None
+            try:
+                tgz = archive.open_tar(raw, offset)
+                for fi in iter_members(tgz):
+                    position = base + fi.offset
+                    if not fi.isreg() or classify(fi.name) is None:
+                        continue
+                    files += 1
+                    while record is not None and (record[0] != b'F' or record[1] < position):
+                        record = next(records, None)
+                    expected = None
+                    if record is not None and record[1] == position:
+                        expected = record[2][0]
+                    if expected is None:
+                        unchecked += 1
+                        continue
+
+                    current = fi.name
+                    handle = tgz.extractfile(fi)
+                    if fi.size <= inline_limit:
+                        data = handle.read()
+                    else:
+                        data = None
+                        if archive.hash_fileobj(handle) != expected:
+                            mismatches += 1
+                            _mismatch(fi.name, 'corrupt')
+                    current = None
+                    checked_bytes += fi.size
+
+                    if data is not None or compare:
+                        size = len(data) if data is not None else 0
+                        future = pool.submit(_verify_member, fi.name, expected, data, compare)
+                        pending.append((fi.name, future, size))
+                        pending_bytes += size
+                        while pending_bytes > pending_limit or len(pending) > 1024:
+                            pending_bytes -= finish(pending.popleft())
+
+                    progress = raw.tell()
+                    if progress - last_progress > 1024 * 1024:
+                        _progress(progress / total * 100, "Verifying backup")
+                        last_progress = progress
+                break
+            except Exception:
+                mismatches += 1
+                _mismatch(current or f'offset {max(position, 0)}', 'unreadable')
+
+            restart = None
+            for checkpoint in checkpoints:
+                if checkpoint[0] > max(position, base):
+                    restart = checkpoint
+                    break
+            if restart is None:
+                break
+
+            # Files between the damaged spot and the checkpoint are lost
+            while record is not None and record[1] < restart[0]:
+                if record[0] == b'F' and record[1] > position:
+                    digest, name = record[2]
+                    if digest is not None and classify(name) is not None:
+                        files += 1
+                        mismatches += 1
+                        _mismatch(name, 'unreadable')
+                record = next(records, None)
+
+            base, offset = restart
+            position = base - 1
+
+        while pending:
+            finish(pending.popleft())
+
+    duration = time.monotonic() - start
+    _stats({
+        "files": files,
+        "unchecked": unchecked,
+        "bytes": checked_bytes,
+        "mismatches": mismatches,
+        "seconds": round(duration, 2),
+        "throughput": int(checked_bytes / duration) if duration > 0 else 0,
+    })
+    return mismatches
+
+
 def sizeof_fmt(num, suffix='B'):
     for unit in ['', 'Ki', 'Mi', 'Gi', 'Ti', 'Pi', 'Ei', 'Zi']:
         if abs(num) < 1024.0:
@@ -396,18 +836,34 @@ def sizeof_fmt(num, suffix='B'):
 
 
 def main(version):
-    global _progress_json
+    global _progress_json, _progress_muted
     import argparse
 
     parser = argparse.ArgumentParser(description="postmarketOS backup utility backend")
     parser.add_argument("target", help="Target/source .tar.gz for the backup")
+    parser.add_argument("--mirror", help="Also write the backup to this target, can be given multiple times",
+                        action="append", metavar="TARGET")
+    parser.add_argument("--compression", help="Compression as NAME[:LEVEL] with NAME one of gzip, zstd, lz4 "
+                                              "or xz, or auto to pick the fastest for this device",
+                        default="gzip:6")
     parser.add_argument("--measure", help="Measure backup size instead of storing it",
                         action="store_true")
     parser.add_argument("--restore", help="Restore instead of backup",
                         action="store_true")
     parser.add_argument("--show", help="Show the contents of a backup file",
                         action="store_true")
+    parser.add_argument("--list", help="List the files of every category with --show",
+                        action="store_true")
+    parser.add_argument("--restore-path", help="Only restore files and directories matching PATTERN",
+                        action="append", dest="restore_path", metavar="PATTERN")
+    parser.add_argument("--verify", help="Check the checksums of the files in a backup",
+                        action="store_true")
+    parser.add_argument("--compare-live", help="Also compare the backup against the files on this system "
+                                               "while verifying", action="store_true", dest="compare_live")
+    parser.add_argument("--jobs", help="Number of worker threads for verifying", type=int)
     parser.add_argument("--json", help="Output json progress", action="store_true")
+    parser.add_argument("--skip-preflight", help="Don't check for free space before the backup",
+                        action="store_true", dest="skip_preflight")
 
     # Options to speed up backup, everything defaults to true to ensure you'll get a
     # usable complete backup if you don't read the instructions. Most of these steps
@@ -426,45 +882,134 @@ def main(version):
     parser.add_argument("--filter", help="Custom restore filter",
                         action="append")
 
+    # Options for unattended backups, the scheduled mode is meant to be started from a
+    # systemd timer and treats the target as a directory to create dated backups in
+    parser.add_argument("--scheduled", help="Run a throttled background backup into the target directory",
+                        action="store_true")
+    parser.add_argument("--keep", help="With --scheduled, remove all but the newest N backups afterwards",
+                        type=int, metavar="N")
+    parser.add_argument("--bwlimit-read", help="Limit reading to RATE bytes per second (K/M/G suffixes)",
+                        type=throttle.parse_rate, dest="bwlimit_read", metavar="RATE")
+    parser.add_argument("--bwlimit-write", help="Limit writing to RATE bytes per second (K/M/G suffixes)",
+                        type=throttle.parse_rate, dest="bwlimit_write", metavar="RATE")
+    parser.add_argument("--nice", help="Lower the CPU priority by this nice increment", type=int)
+    parser.add_argument("--idle-io", help="Use the idle I/O scheduling class",
+                        action="store_true", dest="idle_io")
+    parser.add_argument("--pause-on", help="Pause while a policy applies: battery[:PERCENT] or active",
+                        action="append", dest="pause_on", metavar="POLICY")
+
     args = parser.parse_args()
 
     if args.json:
         _progress_json = True
     if args.show:
-        size, contents = get_archive_info(args.target)
-        tree = {}
-        keys = (size.keys())
-        for key in keys:
-            if '.' in key:
-                key, _ = key.split('.', maxsplit=1)
-            if key not in tree:
-                tree[key] = []
-        for key in sorted(keys):
-            if '.' not in key:
-                continue
-            skey = key
-            key, subkey = key.split('.', maxsplit=1)
-            tree[key].append(subkey)
-            if key not in contents:
-                contents[key] = []
-                size[key] = 0
-            contents[key].extend(contents[skey])
-            size[key] += size[skey]
+        size, count, listing = get_archive_summary(args.target, names=args.list)
+        tree, size, count = group_categories(size, count)
         for key in tree:
-            print(f'{key} | {len(contents[key])} files | {sizeof_fmt(size[key])}')
+            print(f'{key} | {count[key]} files | {sizeof_fmt(size[key])}')
+            if args.list and key in listing:
+                for name in decode_names(listing[key]):
+                    print(f'    {name}')
             for subkey in tree[key]:
                 skey = f'{key}.{subkey}'
-                print(f'    {subkey} | {len(contents[skey])} files | {sizeof_fmt(size[skey])}')
+                print(f'    {subkey} | {count[skey]} files | {sizeof_fmt(size[skey])}')
+                if args.list:
+                    for name in decode_names(listing[skey]):
+                        print(f'        {name}')
+    elif args.verify:
+        if verify(args.target, args.compare_live, args.jobs):
+            return 1
+    elif args.restore_path:
+        restore_path(args.target, args.restore_path)
     elif args.restore:
         restore(args.target, args.filter, args.cross_branch)
+    elif args.measure:
+        result = measure_backup(args.config, args.system, args.apks, args.homedir)
+        if _progress_json:
+            print(json.dumps({"measure": result}))
+        else:
+            for key in ['config', 'system', 'cache', 'homedirs']:
+                print(f'{key} | {sizeof_fmt(result[key])}')
+            for error in result['errors']:
+                print(error)
     else:
-        tgz = save_system_state(args.target, version, args.measure, args.config, args.system,
-                                args.apks, args.homedir)
+        if args.keep is not None and (not args.scheduled or args.keep < 1):
+            parser.error('--keep needs --scheduled and at least 1')
+        directories = []
+        if args.scheduled:
+            directories = [args.target] + (args.mirror or [])
+            os.makedirs(args.target, exist_ok=True)
+            # The file extension is added once the compression is known
+            name = datetime.now().strftime('%Y-%m-%d-%H%M%S') + '.backup'
+            args.target = os.path.join(args.target, name)
+            if args.mirror:
+                for directory in args.mirror:
+                    os.makedirs(directory, exist_ok=True)
+                args.mirror = [os.path.join(directory, name) for directory in args.mirror]
+            if args.nice is None:
+                args.nice = 19
+            args.idle_io = True
+            if args.pause_on is None:
+                args.pause_on = ['battery:20', 'active']
+
+        codec = None
+        level = None
+        try:
+            policies = [throttle.parse_policy(spec) for spec in args.pause_on or []]
+            if args.compression != 'auto':
+                codec, level = compression.parse(args.compression)
+        except ValueError as e:
+            parser.error(str(e))
+        throttle.set_priority(args.nice, args.idle_io, on_error=_error)
+
+        limits = None
+        if args.bwlimit_read or args.bwlimit_write or policies:
+            limits = throttle.Throttle(args.bwlimit_read, args.bwlimit_write, policies, on_pause=_paused)
+
+        # Data used to estimate the compression
+        sources = ['/home'] if args.homedir else ['/etc']
+
+        count = None
+        if not args.skip_preflight:
+            # One step for the progress bar, the measurement's own progress would make it
+            # jump back when the backup starts
+            _progress(0, "Estimating backup size")
+            _progress_muted = True
+            try:
+                sizes = measure_backup(args.config, args.system, args.apks, args.homedir)
+            finally:
+                _progress_muted = False
+            targets = preflight([args.target] + (args.mirror or []), sizes, codec, level, sources)
+            if not targets:
+                return 1
+            args.target = targets[0]
+            args.mirror = targets[1:]
+            count = sizes['files']
+
+        if args.compression == 'auto':
+            _progress(0, "Selecting compression")
+            os.makedirs(os.path.dirname(args.target), exist_ok=True)
+            codec, level = compression.choose(os.path.dirname(args.target), sources)
+            _progress(0, f"Using {codec.name} level {level}")
+
+        if args.scheduled:
+            args.target += codec.suffix
+            if args.mirror:
+                args.mirror = [mirror + codec.suffix for mirror in args.mirror]
+
+        start = time.monotonic()
+        tgz = save_system_state(args.target, version, False, args.config, args.system,
+                                args.apks, args.homedir, limits, args.mirror, codec, level)
         if args.homedir:
-            save_homedirs(args.target, tgz)
-
-        if not isinstance(tgz, dict):
-            tgz.close()
+            save_homedirs(args.target, tgz, count, args.mirror)
+        tgz.close()
+        record_run(tgz, time.monotonic() - start)
+
+        if args.keep:
+            # A target that failed during the backup keeps its old backups
+            for directory in directories:
+                if os.path.exists(os.path.join(directory, os.path.basename(args.target))):
+                    prune_backups(directory, args.keep)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,158 @@
+import glob
+import os
+import subprocess
+import time
+
+
+def parse_rate(value):
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper().rstrip('B').rstrip('I')
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def set_priority(nice=None, idle_io=False, on_error=None):
+    if nice:
+        os.nice(nice)
+    if idle_io:
+        # Only do I/O when no other process needs the disk. Running without it is better
+        # than not running the backup at all.
+        try:
+            subprocess.run(['ionice', '-c', '3', '-p', str(os.getpid())], check=False)
+        except OSError as e:
+            if on_error:
+                on_error(f'Could not set the idle I/O class: {e}')
+
+
+def _read_sysfs(path):
+    try:
+        with open(path) as handle:
+            return handle.read().strip()
+    except OSError:
+        return None
+
+
+def battery_policy(minimum='20'):
+    minimum = int(minimum)
+
+    def check():
+        for supply in glob.glob('/sys/class/power_supply/*'):
+            if _read_sysfs(os.path.join(supply, 'type')) != 'Battery':
+                continue
+            if _read_sysfs(os.path.join(supply, 'status')) in ['Charging', 'Full']:
+                continue
+            capacity = _read_sysfs(os.path.join(supply, 'capacity'))
+            if capacity is not None and int(capacity) < minimum:
+                return f'Battery below {minimum}%'
+        return None
+
+    return check
+
+
+def active_policy():
+    def check():
+        # The device is considered in use while the display is on
+        for backlight in glob.glob('/sys/class/backlight/*'):
+            if _read_sysfs(os.path.join(backlight, 'bl_power')) not in [None, '0']:
+                continue
+            if _read_sysfs(os.path.join(backlight, 'brightness')) not in [None, '0']:
+                return 'Device is in use'
+        return None
+
+    return check
+
+
+POLICIES = {
+    'battery': battery_policy,
+    'active': active_policy,
+}
+
+
+def parse_policy(spec):
+    name, _, arg = spec.partition(':')
+    if name not in POLICIES:
+        raise ValueError(f'Unknown pause policy: {name}')
+    if arg:
+        return POLICIES[name](arg)
+    return POLICIES[name]()
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.total = 0
+
+    def __call__(self, amount):
+        self.total += amount
+        ahead = self.total / self.rate - (time.monotonic() - self.start)
+        if ahead > 0:
+            time.sleep(ahead)
+
+    def reset(self):
+        self.start = time.monotonic()
+        self.total = 0
+
+
+class Throttle:
+    def __init__(self, read_rate=None, write_rate=None, policies=None, on_pause=None,
+                 check_interval=10, pause_interval=60):
+        self.read_limiter = RateLimiter(read_rate) if read_rate else None
+        self.write_limiter = RateLimiter(write_rate) if write_rate else None
+        self.policies = policies or []
+        self.on_pause = on_pause
+        self.check_interval = check_interval
+        self.pause_interval = pause_interval
+        self._last_check = 0
+
+    def read(self, amount):
+        if self.read_limiter:
+            self.read_limiter(amount)
+
+    def write(self, amount):
+        if self.write_limiter:
+            self.write_limiter(amount)
+
+    def _reason(self):
+        for policy in self.policies:
+            reason = policy()
+            if reason:
+                return reason
+        return None
+
+    def check(self):
+        now = time.monotonic()
+        if not self.policies or now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+
+        paused = False
+        while True:
+            reason = self._reason()
+            if reason is None:
+                break
+            if self.on_pause:
+                self.on_pause(reason)
+            paused = True
+            time.sleep(self.pause_interval)
+
+        if paused:
+            # Don't make up for the paused time by bursting
+            for limiter in [self.read_limiter, self.write_limiter]:
+                if limiter:
+                    limiter.reset()
+            self._last_check = time.monotonic()
+
+
+class ThrottledWriter:
+    def __init__(self, raw, throttle):
+        self.raw = raw
+        self.throttle = throttle
+
+    def write(self, data):
+        self.throttle.write(len(data))
+        return self.raw.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
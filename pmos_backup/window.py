@@ -7,7 +7,7 @@ import json
 import gi
 
 from pmos_backup import backupinfo
-from pmos_backup.state import get_archive_info
+from pmos_backup.state import get_archive_summary, group_categories
 
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, GLib, GObject, Gio, Gdk, GLib
@@ -287,7 +287,7 @@ class BackupWindow:
             self.restore_warning.set_text(text)
             self.restore_warning.show()
 
-        size, contents = get_archive_info(filename)
+        size, count, _ = get_archive_summary(filename)
         names = {
             "packages": "Installed packages",
             "config": "System configuration",
@@ -295,17 +295,7 @@ class BackupWindow:
             "homedir": "Home directories",
             "sideloaded": "Sideloaded packages"
         }
-        tree = {}
-        for key in size.keys():
-            if '.' in key:
-                key, _ = key.split('.', maxsplit=1)
-            if key not in tree:
-                tree[key] = []
-        for key in sorted(size.keys()):
-            if '.' not in key:
-                continue
-            key, subkey = key.split('.', maxsplit=1)
-            tree[key].append(subkey)
+        tree, size, count = group_categories(size, count)
 
         for key in tree:
             name = key
@@ -322,7 +312,7 @@ class BackupWindow:
                     mark.set_sensitive(True)
                 self.restore_checks[key] = mark
                 self.restore_box.pack_start(mark, False, False, 0)
-                detail = Gtk.Label("{} files, {} bytes".format(len(contents[key]), self.sizeof_fmt(size[key])))
+                detail = Gtk.Label("{} files, {} bytes".format(count[key], self.sizeof_fmt(size[key])))
                 detail.set_margin_start(25)
                 detail.set_margin_bottom(10)
                 detail.get_style_context().add_class('dim-label')
@@ -343,7 +333,7 @@ class BackupWindow:
                 self.restore_checks[skey] = mark
                 self.restore_box.pack_start(mark, False, False, 0)
 
-                detail = Gtk.Label("{} files, {} bytes".format(len(contents[skey]), self.sizeof_fmt(size[skey])))
+                detail = Gtk.Label("{} files, {} bytes".format(count[skey], self.sizeof_fmt(size[skey])))
                 detail.set_margin_start(25 + 24)
                 detail.set_margin_bottom(10)
                 detail.get_style_context().add_class('dim-label')